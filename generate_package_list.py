@@ -1,64 +1,86 @@
 """Module to generate a full dependency list from list of packages."""
 import argparse
+import contextlib
 import dataclasses
+import gzip
+import hashlib
 import pathlib
+import pickle
 import re
+import shutil
 import subprocess
-from urllib import request
+import sys
+import tempfile
+from collections.abc import Iterable, Iterator
+from concurrent import futures
 
 import toposort
+import urllib3
+
+re_pkg_name = re.compile(r"[A-Za-z][A-Za-z0-9_.]+", re.ASCII)
+
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / ".cache" / "generate_package_list"
+# Bump whenever the layout of RPackage changes, to invalidate old caches
+CACHE_VERSION = 3
+
+http_pool = urllib3.PoolManager(maxsize=DOWNLOAD_WORKERS, retries=3)
+
+
+R_INCLUDED = frozenset(
+    {
+        "R",  # base
+        "base",
+        "compiler",
+        "datasets",
+        "graphics",
+        "grDevices",
+        "grid",
+        "methods",
+        "parallel",
+        "splines",
+        "stats",
+        "stats4",
+        "tcltk",
+        "utils",
+        "tools",
+        "KernSmooth",  # recommended
+        "MASS",
+        "Matrix",
+        "boot",
+        "class",
+        "cluster",
+        "codetools",
+        "foreign",
+        "lattice",
+        "mgcv",
+        "nlme",
+        "nnet",
+        "rpart",
+        "spatial",
+        "survival",
+    }
+)
+
 
-re_line_fixer = re.compile(r"(\n +)", re.MULTILINE)
-re_key_value = re.compile(r"^([A-Za-z0-9]+):\s*(.+)$", re.MULTILINE)
-re_pkg_name = re.compile(r"[A-Za-z][A-Za-z0-9_\.]+")
-
-
-R_INCLUDED = [
-    "R",  # base
-    "base",
-    "compiler",
-    "datasets",
-    "graphics",
-    "grDevices",
-    "grid",
-    "methods",
-    "parallel",
-    "splines",
-    "stats",
-    "stats4",
-    "tcltk",
-    "utils",
-    "tools",
-    "KernSmooth",  # recommended
-    "MASS",
-    "Matrix",
-    "boot",
-    "class",
-    "cluster",
-    "codetools",
-    "foreign",
-    "lattice",
-    "mgcv",
-    "nlme",
-    "nnet",
-    "rpart",
-    "spatial",
-    "survival",
-]
-
-
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class RPackage:
     """An R package class."""
 
     name: str
     version: str
-    deps: set[str]
+    deps: frozenset[str]
+    # Full name of package (including version number)
+    full_name: str = dataclasses.field(init=False, repr=False)
+    # File name of the source tarball of the package
+    tarball_name: str = dataclasses.field(init=False, repr=False)
 
-    @property
-    def full_name(self) -> str:
-        """Full name of package (including version number)."""
-        return f"{self.name}_{self.version}"
+    def __post_init__(self) -> None:
+        """Compute the derived names once, instead of on every access."""
+        self.full_name = f"{self.name}_{self.version}"
+        self.tarball_name = f"{self.full_name}.tar.gz"
 
     @classmethod
     def from_raw(cls, raw_input: str) -> "RPackage":
@@ -67,42 +89,33 @@ class RPackage:
         :param raw_input: The raw string to parse
         :return: An RPackage instance
         """
-        raw_input = re_line_fixer.sub(" ", raw_input)
-        input_dict = dict(re_key_value.findall(raw_input))
-
-        name = input_dict["Package"]
-        version = input_dict["Version"]
-
-        deps = []
-        if "Depends" in input_dict:
-            deps = re_pkg_name.findall(input_dict["Depends"])
+        return cls.from_fields(next(_parse_fields(raw_input.splitlines())))
 
-        if "Imports" in input_dict:
-            imps = re_pkg_name.findall(input_dict["Imports"])
-            deps.extend(imps)
+    @classmethod
+    def from_fields(cls, fields: dict[str, str]) -> "RPackage":
+        """Create RPackage object from the parsed fields of a package.
 
-        if "LinkingTo" in input_dict:
-            link = re_pkg_name.findall(input_dict["LinkingTo"])
-            deps.extend(link)
+        :param fields: The fields of the package, keyed by field name
+        :return: An RPackage instance
+        """
+        raw_deps = ", ".join(
+            fields[key] for key in ("Depends", "Imports", "LinkingTo") if key in fields
+        )
+        # Intern the names, so each name is stored once however many
+        # packages depend on it
+        deps = frozenset(map(sys.intern, re_pkg_name.findall(raw_deps)))
 
-        return cls(name, version, set(deps))
+        return cls(sys.intern(fields["Package"]), fields["Version"], deps - R_INCLUDED)
 
     def download(self, repo_url: str) -> None:
         """Download the R package from specified repo.
 
         :param repo_url: Url from repo to download package from
         """
-        subprocess.run(
-            f'wget "{repo_url}/{self.full_name}.tar.gz" -O "{self.full_name}.tar.gz"',
-            shell=True,
-            check=True,
-        )
-
-    def build(self) -> None:
-        """Build the R package."""
-        subprocess.run(
-            f'R CMD INSTALL --build "{self.full_name}.tar.gz"', shell=True, check=True
-        )
+        with _open_url(f"{repo_url}/{self.tarball_name}") as response, open(
+            self.tarball_name, "wb"
+        ) as tarball:
+            shutil.copyfileobj(response, tarball, DOWNLOAD_CHUNK_SIZE)
 
 
 def main() -> None:
@@ -115,11 +128,11 @@ def main() -> None:
     main_dependencies_file_path = args.src
 
     # Generate a list of all packages in the repo
-    raw_repo_package_list = _download_raw_repo_package_list(repo_url)
-    repo_package_list = _parse_repo_package_list(raw_repo_package_list)
+    cache_dir = None if args.no_cache else args.cache_dir
+    repo_package_list = _download_repo_package_list(repo_url, cache_dir)
 
-    # Generate a topological list of dependencies (and sub-dependencies)
-    # from src file
+    # Generate a topological list of levels of dependencies (and
+    # sub-dependencies) from src file
     dependencies = _generate_full_dependency_list(
         main_dependencies_file_path, repo_package_list
     )
@@ -146,98 +159,263 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         "-b", "--build", action="store_true", help="Download and build the packages"
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=DEFAULT_CACHE_DIR,
+        help="Directory to cache the parsed repo package list in",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't cache the parsed repo package list",
+    )
     return parser.parse_args()
 
 
-def _download_raw_repo_package_list(url: str) -> str:
-    """Download the repo package list from specified url.
+@contextlib.contextmanager
+def _open_url(
+    url: str,
+    headers: dict[str, str] | None = None,
+    allowed_statuses: tuple[int, ...] = (200,),
+) -> Iterator[urllib3.BaseHTTPResponse]:
+    """Open a url using a connection from the shared connection pool.
+
+    The connection is released back to the pool when the context is exited.
+
+    :param url: The url to open
+    :param headers: Additional request headers, e.g. for a conditional request
+    :param allowed_statuses: HTTP statuses that don't raise an error
+    :return: The (unread) response
+    """
+    response = http_pool.request(
+        "GET", url, headers=headers, preload_content=False, decode_content=False
+    )
+    try:
+        if response.status not in allowed_statuses:
+            raise urllib3.exceptions.HTTPError(
+                f"Failed to download {url}: HTTP status {response.status}"
+            )
+        yield response
+    except BaseException:
+        # Don't hand a partially read connection back to the pool
+        response.close()
+        raise
+    finally:
+        response.release_conn()
+
+
+def _download_repo_package_list(
+    url: str, cache_dir: pathlib.Path | None = None
+) -> dict[str, RPackage]:
+    """Download and parse the repo package list from specified url.
+
+    The compressed package list is decompressed and parsed while it is being
+    downloaded. If a cache directory is given, the parsed list is stored there
+    and reused for as long as the repo reports it as not modified.
 
     :param url: The url to the repo
-    :return: A raw list of all packages in the repo
+    :param cache_dir: Directory to cache the parsed package list in
+    :return: List of RPackages that the repo contains
     """
-    with request.urlopen(f"{url}/PACKAGES") as response:
-        return response.read().decode("utf-8")
+    package_list_url = f"{url}/PACKAGES.gz"
+
+    cache_path = None
+    cached_headers: dict[str, str] = {}
+    if cache_dir is not None:
+        url_hash = hashlib.sha256(package_list_url.encode("utf-8")).hexdigest()
+        cache_path = cache_dir / f"{url_hash}-v{CACHE_VERSION}.pickle"
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cached_headers, cached_package_list = pickle.load(cache_file)
+        except (
+            OSError,
+            pickle.UnpicklingError,
+            EOFError,
+            AttributeError,
+            TypeError,
+            ValueError,
+        ):
+            # No usable cache, so download the package list unconditionally
+            cached_headers = {}
+
+    # Not Modified is only a valid answer if the request was conditional
+    allowed_statuses = (200, 304) if cached_headers else (200,)
+    with _open_url(package_list_url, cached_headers, allowed_statuses) as response:
+        if response.status == 304:
+            return cached_package_list
+
+        with gzip.open(response, "rt", encoding="utf-8") as lines:
+            repo_package_list = _parse_repo_package_list(lines)
+
+    # Store the validators needed to make a conditional request next time
+    headers = {}
+    if "ETag" in response.headers:
+        headers["If-None-Match"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        headers["If-Modified-Since"] = response.headers["Last-Modified"]
+
+    if cache_path is not None and headers:
+        # Write to a temporary file unique to this run first, so concurrent
+        # runs never move a partially written cache into place
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_file = tempfile.NamedTemporaryFile(
+            dir=cache_path.parent, suffix=".tmp", delete=False
+        )
+        tmp_cache_path = pathlib.Path(cache_file.name)
+        try:
+            with cache_file:
+                pickle.dump((headers, repo_package_list), cache_file)
+            tmp_cache_path.replace(cache_path)
+        except BaseException:
+            tmp_cache_path.unlink(missing_ok=True)
+            raise
+
+    return repo_package_list
 
 
-def _parse_repo_package_list(raw_repo_package_list: str) -> dict[str, RPackage]:
-    """Parse the raw repo package list into list of RPackage instances.
+def _parse_repo_package_list(lines: Iterable[str]) -> dict[str, RPackage]:
+    """Parse the lines of the repo package list into list of RPackage instances.
 
-    :param raw_repo_package_list: Raw package list
+    :param lines: Lines of the raw package list
     :return: List of RPackages that the repo contains
     """
-    return {
-        r_package.name: r_package
-        for r_package in [
-            RPackage.from_raw(pkg)
-            for pkg in raw_repo_package_list.split("\n\n")
-            if pkg.startswith("Package:")
-        ]
-    }
+    packages = (
+        RPackage.from_fields(fields)
+        for fields in _parse_fields(lines)
+        if "Package" in fields
+    )
+    # Key by the interned name, so the key doesn't store another copy of it
+    return {package.name: package for package in packages}
+
+
+def _parse_fields(lines: Iterable[str]) -> Iterator[dict[str, str]]:
+    """Parse lines in the Debian control file format into records of fields.
+
+    Records are separated by blank lines; continuation lines (starting with
+    whitespace) are joined onto the value of the preceding field.
+
+    :param lines: The lines to parse
+    :return: An iterator over the fields of each record
+    """
+    fields: dict[str, str] = {}
+    key = None
+    parts: list[str] = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped and line[0] in " \t":
+            parts.append(stripped)
+            continue
+
+        # Store the previous field only once all its lines have been seen
+        if key is not None:
+            fields[key] = " ".join(parts)
+            key = None
+
+        if not stripped:
+            if fields:
+                yield fields
+            fields = {}
+        else:
+            key, _, value = stripped.partition(":")
+            parts = [value.strip()]
+
+    if key is not None:
+        fields[key] = " ".join(parts)
+    if fields:
+        yield fields
 
 
 def _generate_full_dependency_list(
     main_dependencies_file_path: pathlib.Path, repo_package_list: dict[str, RPackage]
-) -> list[RPackage]:
+) -> list[list[RPackage]]:
     """Generates a list of all (sub) dependencies.
 
+    The packages are grouped in levels; the packages in a level only depend on
+    packages in the levels before it.
+
     :param main_dependencies_file_path: Path to file containing main
       dependencies
     :param repo_package_list: List of packages in the repo
-    :return: A topological list containing all dependencies and sub-dependencies
+    :return: A topological list of levels containing all dependencies and
+      sub-dependencies, leaving out dependencies that are not in the repo
+    :raises ValueError: If a main dependency is not in the repo
     """
 
     with open(main_dependencies_file_path, "r", encoding="utf-8") as main_dependencies:
-        packages = [package_name.strip() for package_name in main_dependencies]
-        packages_set = set(packages)
-        for package in packages:
-            deps = _get_sub_dependencies(package, repo_package_list)
-            packages_set.update(deps)
-
-        pkgs_dict = {
-            name: repo_package_list[name].deps
-            for name in packages_set
-            if name not in R_INCLUDED
-        }
-
-        packages = toposort.toposort_flatten(pkgs_dict)
-
-        return [
-            repo_package_list[package]
-            for package in packages
-            if package not in R_INCLUDED
-        ]
-
-
-def _get_sub_dependencies(
-    name: str, repo_package_list: dict[str, RPackage]
-) -> set[str]:
-    """Returns the dependencies of a package.
-
-    :param name: Name of the main package
-    :param repo_package_list: List of all packages in the repo
-    :return: A set of dependencies of the package
-    """
-    package = repo_package_list[name]
-    deps = set(package.deps)
-    for dep in package.deps:
-        if dep in R_INCLUDED:
+        packages = [line.strip() for line in main_dependencies if line.strip()]
+
+    unknown = [
+        name
+        for name in packages
+        if name not in R_INCLUDED and name not in repo_package_list
+    ]
+    if unknown:
+        raise ValueError(f"Packages not found in repo: {', '.join(unknown)}")
+
+    # Walk the dependency graph, looking up every package only once
+    found: dict[str, RPackage] = {}
+    missing: set[str] = set()
+    stack = [name for name in packages if name not in R_INCLUDED]
+    while stack:
+        name = stack.pop()
+        if name in found or name in missing:
+            continue
+        package = repo_package_list.get(name)
+        if package is None:
+            print(f"Package {name} not found in repo, skipping", file=sys.stderr)
+            missing.add(name)
             continue
-        dep_deps = _get_sub_dependencies(dep, repo_package_list)
-        deps.update(dep_deps)
-    return deps
+        found[name] = package
+        stack.extend(package.deps)
+
+    pkgs_dict = {name: package.deps for name, package in found.items()}
+    # Sort each level, so the order doesn't depend on the hash seed
+    levels = (
+        [found[name] for name in sorted(level) if name not in missing]
+        for level in toposort.toposort(pkgs_dict)
+    )
+
+    return [level for level in levels if level]
 
 
 def _download_and_build_dependencies(
-    package_list: list[RPackage], repo_url: str
+    package_levels: list[list[RPackage]], repo_url: str
 ) -> None:
-    """Downloads and builds a list of R packages.
+    """Downloads and builds a topological list of levels of R packages.
+
+    The packages are downloaded concurrently, but built level by level in the
+    order of the list as soon as the downloads of a level have finished.
 
-    :param package_list: List of packages to build
+    :param package_levels: Levels of packages to build
     :param repo_url: Url of the repo to download packages from
     """
-    for package in package_list:
-        package.download(repo_url)
-        package.build()
+    with futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        downloads = [
+            [executor.submit(package.download, repo_url) for package in level]
+            for level in package_levels
+        ]
+        try:
+            for level, level_downloads in zip(package_levels, downloads):
+                for download in level_downloads:
+                    download.result()
+                _build_packages(level)
+        except BaseException:
+            # Don't wait for the remaining downloads once one has failed
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def _build_packages(packages: list[RPackage]) -> None:
+    """Build R packages that don't depend on each other in a single R session.
+
+    :param packages: The packages to build
+    """
+    subprocess.run(
+        ["R", "CMD", "INSTALL", "--build"]
+        + [package.tarball_name for package in packages],
+        check=True,
+    )
 
 
 if __name__ == "__main__":
@@ -1,4 +1,14 @@
+import functools
+import gzip
+import http.server
+import os
+import pathlib
+import pickle
+import threading
+from collections.abc import Iterator
+
 import pytest
+import urllib3
 
 import generate_package_list
 
@@ -35,6 +45,30 @@ def _generate_raw_package_input(
     return "\n".join(package_input_list)
 
 
+class _QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """HTTP request handler that does not log the requests."""
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def repo(tmp_path: pathlib.Path) -> Iterator[tuple[pathlib.Path, str]]:
+    """Serve a temporary repo directory over HTTP.
+
+    :param tmp_path: Temporary directory provided by pytest
+    :return: The path to the repo directory and the url it is served on
+    """
+    repo_path = tmp_path / "repo"
+    repo_path.mkdir()
+    handler = functools.partial(_QuietHTTPRequestHandler, directory=repo_path)
+    with http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield repo_path, f"http://127.0.0.1:{server.server_port}"
+        server.shutdown()
+
+
 def test_r_package_from_raw_name_and_version() -> None:
     """Test that RPackage instance can be created from raw input."""
     # GIVEN raw package input
@@ -63,3 +97,228 @@ def test_r_package_from_raw_deps(deps_key: str) -> None:
 
     # THEN the RPackage contains the correct deps
     assert all([depend in r_package.deps for depend in deps])
+
+
+def test_generate_full_dependency_list_order(tmp_path) -> None:
+    """Dependencies should be listed before the packages depending on them."""
+    # GIVEN a repo with a diamond shaped dependency graph
+    raw_packages = [
+        _generate_raw_package_input("top", depends=["R", "left", "right"]),
+        _generate_raw_package_input("left", imports=["bottom", "stats"]),
+        _generate_raw_package_input("right", linking_to=["bottom"]),
+        _generate_raw_package_input("bottom"),
+        _generate_raw_package_input("unused"),
+    ]
+    repo_package_list = generate_package_list._parse_repo_package_list(
+        "\n\n".join(raw_packages).splitlines()
+    )
+    # AND a main dependencies file containing the top package
+    main_dependencies_file_path = tmp_path / "packages.txt"
+    main_dependencies_file_path.write_text("top\n", encoding="utf-8")
+
+    # WHEN the full dependency list is generated
+    dependencies = generate_package_list._generate_full_dependency_list(
+        main_dependencies_file_path, repo_package_list
+    )
+
+    # THEN every package is in a level after its dependencies
+    # AND it contains all (sub) dependencies and nothing else
+    levels = [[package.name for package in level] for level in dependencies]
+    assert levels == [["bottom"], ["left", "right"], ["top"]]
+
+
+def test_r_package_from_raw_excludes_r_included() -> None:
+    """RPackage should not include packages shipped with R in the deps."""
+    # GIVEN raw package input depending on base and recommended packages
+    raw_package_input = _generate_raw_package_input(
+        depends=["R (>= 3.5.0)", "package_one"], imports=["stats", "MASS"]
+    )
+
+    # WHEN a RPackage instance is created from this input
+    r_package = generate_package_list.RPackage.from_raw(raw_package_input)
+
+    # THEN only the packages not included with R are in the deps
+    assert r_package.deps == {"package_one"}
+
+
+def test_parse_repo_package_list_continuation_lines() -> None:
+    """Fields spanning multiple lines should be parsed as a single value."""
+    # GIVEN a raw package list where the deps continue on the next lines
+    raw_repo_package_list = "\n\n".join(
+        [
+            _generate_raw_package_input("package_one", imports=["package_two"]),
+            "Package: package_two\n"
+            "Version: 2.0.0\n"
+            "Imports: package_three,\n"
+            "        package_four (>= 1.0.0),\n"
+            "\tpackage_five\n"
+            "License: MIT",
+        ]
+    )
+
+    # WHEN the package list is parsed
+    repo_package_list = generate_package_list._parse_repo_package_list(
+        raw_repo_package_list.splitlines()
+    )
+
+    # THEN all packages are in the parsed list
+    assert set(repo_package_list) == {"package_one", "package_two"}
+    # AND the deps on the continuation lines are included
+    assert repo_package_list["package_two"].deps == {
+        "package_three",
+        "package_four",
+        "package_five",
+    }
+
+
+def test_r_package_download(repo, tmp_path, monkeypatch) -> None:
+    """RPackage should download its tarball from the repo."""
+    # GIVEN a repo containing the tarball of a package
+    repo_path, repo_url = repo
+    (repo_path / "package_name_1.0.0.tar.gz").write_bytes(b"tarball contents")
+    r_package = generate_package_list.RPackage.from_raw(_generate_raw_package_input())
+    # AND a separate working directory
+    work_path = tmp_path / "work"
+    work_path.mkdir()
+    monkeypatch.chdir(work_path)
+
+    # WHEN the package is downloaded
+    r_package.download(repo_url)
+
+    # THEN the tarball is in the working directory
+    assert (work_path / "package_name_1.0.0.tar.gz").read_bytes() == (
+        b"tarball contents"
+    )
+
+
+def test_download_repo_package_list(repo) -> None:
+    """The compressed package list should be downloaded and parsed."""
+    # GIVEN a repo with a compressed package list
+    raw_repo_package_list = "\n\n".join(
+        [
+            _generate_raw_package_input("package_one", imports=["package_two"]),
+            _generate_raw_package_input("package_two", version="2.0.0"),
+        ]
+    )
+    repo_path, repo_url = repo
+    with gzip.open(repo_path / "PACKAGES.gz", "wt", encoding="utf-8") as packages:
+        packages.write(raw_repo_package_list)
+
+    # WHEN the package list is downloaded
+    repo_package_list = generate_package_list._download_repo_package_list(repo_url)
+
+    # THEN all packages are in the parsed list
+    assert set(repo_package_list) == {"package_one", "package_two"}
+    # AND the packages are parsed correctly
+    assert repo_package_list["package_two"].version == "2.0.0"
+    assert repo_package_list["package_one"].deps == {"package_two"}
+
+
+def test_generate_full_dependency_list_missing(tmp_path, capsys) -> None:
+    """Dependencies missing from the repo should be reported and skipped."""
+    # GIVEN a repo where a dependency of two packages is missing
+    raw_packages = [
+        _generate_raw_package_input("top", depends=["left", "right"]),
+        _generate_raw_package_input("left", imports=["missing"]),
+        _generate_raw_package_input("right", imports=["missing"]),
+    ]
+    repo_package_list = generate_package_list._parse_repo_package_list(
+        "\n\n".join(raw_packages).splitlines()
+    )
+    # AND a main dependencies file containing the top package
+    main_dependencies_file_path = tmp_path / "packages.txt"
+    main_dependencies_file_path.write_text("top\n", encoding="utf-8")
+
+    # WHEN the full dependency list is generated
+    dependencies = generate_package_list._generate_full_dependency_list(
+        main_dependencies_file_path, repo_package_list
+    )
+
+    # THEN it contains all packages in the repo
+    levels = [[package.name for package in level] for level in dependencies]
+    assert levels == [["left", "right"], ["top"]]
+    # AND the missing package is reported once
+    assert capsys.readouterr().err.count("missing") == 1
+
+
+def test_r_package_download_missing(repo, tmp_path, monkeypatch) -> None:
+    """RPackage should raise if its tarball is not in the repo."""
+    # GIVEN an empty repo
+    _, repo_url = repo
+    r_package = generate_package_list.RPackage.from_raw(_generate_raw_package_input())
+    monkeypatch.chdir(tmp_path)
+
+    # WHEN the package is downloaded
+    # THEN an error is raised
+    with pytest.raises(urllib3.exceptions.HTTPError):
+        r_package.download(repo_url)
+
+
+def test_download_repo_package_list_cached(repo, tmp_path) -> None:
+    """The cached package list should be used if the repo is not modified."""
+    # GIVEN a repo with a compressed package list
+    repo_path, repo_url = repo
+    packages_path = repo_path / "PACKAGES.gz"
+    with gzip.open(packages_path, "wt", encoding="utf-8") as packages:
+        packages.write(_generate_raw_package_input("package_one"))
+    # AND the package list has been downloaded into the cache before
+    cache_dir = tmp_path / "cache"
+    generate_package_list._download_repo_package_list(repo_url, cache_dir)
+
+    # WHEN the package list changes without its modification time changing
+    stat = packages_path.stat()
+    with gzip.open(packages_path, "wt", encoding="utf-8") as packages:
+        packages.write(_generate_raw_package_input("package_two"))
+    os.utime(packages_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    # AND the package list is downloaded again
+    repo_package_list = generate_package_list._download_repo_package_list(
+        repo_url, cache_dir
+    )
+
+    # THEN the cached package list is returned
+    assert set(repo_package_list) == {"package_one"}
+
+
+def test_generate_full_dependency_list_missing_main(tmp_path) -> None:
+    """Main dependencies missing from the repo should raise an error."""
+    # GIVEN a repo containing a single package
+    repo_package_list = generate_package_list._parse_repo_package_list(
+        _generate_raw_package_input("package_one").splitlines()
+    )
+    # AND a main dependencies file with a package that is not in the repo
+    main_dependencies_file_path = tmp_path / "packages.txt"
+    main_dependencies_file_path.write_text(
+        "package_one\npackage_typo\n\n", encoding="utf-8"
+    )
+
+    # WHEN the full dependency list is generated
+    # THEN an error naming the missing package is raised
+    with pytest.raises(ValueError, match="package_typo"):
+        generate_package_list._generate_full_dependency_list(
+            main_dependencies_file_path, repo_package_list
+        )
+
+
+def test_download_repo_package_list_corrupt_cache(repo, tmp_path) -> None:
+    """A corrupt cache should be ignored and replaced."""
+    # GIVEN a repo with a compressed package list
+    repo_path, repo_url = repo
+    with gzip.open(repo_path / "PACKAGES.gz", "wt", encoding="utf-8") as packages:
+        packages.write(_generate_raw_package_input("package_one"))
+    # AND the package list has been downloaded into the cache before
+    cache_dir = tmp_path / "cache"
+    generate_package_list._download_repo_package_list(repo_url, cache_dir)
+    # AND the cached file has been corrupted
+    (cache_path,) = cache_dir.iterdir()
+    cache_path.write_bytes(b"garbage")
+
+    # WHEN the package list is downloaded again
+    repo_package_list = generate_package_list._download_repo_package_list(
+        repo_url, cache_dir
+    )
+
+    # THEN the package list is downloaded from the repo
+    assert set(repo_package_list) == {"package_one"}
+    # AND the cache has been rewritten
+    _, cached_package_list = pickle.loads(cache_path.read_bytes())
+    assert set(cached_package_list) == {"package_one"}